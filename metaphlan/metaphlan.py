@@ -11,7 +11,7 @@ __date__ = '11 Mar 2024'
 
 import sys
 try:
-    from metaphlan import mybytes, plain_read_and_split, plain_read_and_split_line, read_and_split, read_and_split_line, check_and_install_database, remove_prefix
+    from metaphlan import mybytes, plain_read_and_split, check_and_install_database, remove_prefix
 except ImportError:
     sys.exit("CRITICAL ERROR: Unable to find the MetaPhlAn python package. Please check your install.")
 
@@ -22,15 +22,17 @@ if float(sys.version_info[0]) < 3.0:
 import os
 import stat
 import re
+import shutil
 import time
 import random
-from collections import defaultdict as defdict
 from distutils.version import LooseVersion
 from glob import glob
 from subprocess import DEVNULL
 import argparse as ap
 import bz2
 import gzip
+import io
+import mmap
 import pickle
 import subprocess as subp
 import tempfile as tf
@@ -47,6 +49,7 @@ try:
     import pandas as pd
     import numpy as np
     import pysam
+    from numba import njit
 except Exception as e:
     sys.stderr.write("Error! python library not detected\n{}\n".format(e))
     sys.exit(1)
@@ -66,10 +69,23 @@ except Exception as e:
 try:
     import biom
     import biom.table
+    import scipy.sparse
 except ImportError:
     sys.stderr.write("Warning! Biom python library not detected!"
                      "\n Exporting to biom format will not work!\n")
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import indexed_bzip2
+except ImportError:
+    indexed_bzip2 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # get the directory that contains this script
 metaphlan_script_install_folder = os.path.dirname(os.path.abspath(__file__))
@@ -80,6 +96,10 @@ DEFAULT_DB_FOLDER= os.environ.get('METAPHLAN_DB_DIR', DEFAULT_DB_FOLDER)
 SGB_ANALYSIS = True
 INDEX = 'latest'
 tax_units = "kpcofgst"
+BUFFER_SIZE = 1 << 20
+# the aligned (M) runs of a CIGAR string, for the str and the bytes SAM lines
+CIGAR_MATCHES = re.compile(r"(\d+)M")
+CIGAR_MATCHES_B = re.compile(rb"(\d+)M")
 
 def read_params(args):
     p = ap.ArgumentParser( description =
@@ -221,6 +241,9 @@ def read_params(args):
         help="Minimum mapping quality value (MAPQ) [default 5]")
     arg('--no_map', action='store_true',
         help="Avoid storing the --bowtie2out map file")
+    arg('--reuse_bowtie2out', action='store_true',
+        help="Profile an existing --bowtie2out map file instead of re-running BowTie2, "
+             "if it is newer than the input files")
     arg('--tmp_dir', metavar="", default=None, type=str,
         help="The folder used to store temporary files [default is the OS "
              "dependent tmp dir]")
@@ -373,6 +396,10 @@ def read_params(args):
         help="If used, MetaPhlAn will not check for new database updates.")
     arg('--force_download', action='store_true',
         help="Force the re-download of the latest MetaPhlAn database.")
+    arg('--uncompressed_db_cache', action='store_true',
+        help="Write an uncompressed copy of the database pickle next to it (<database>.pkl.uncompressed.pkl), so that "
+             "the next runs skip the bz2 decompression. The database folder must be writable. An up-to-date copy is "
+             "always used when present, even without this option.")
     arg('--read_min_len', type=int, default=70,
         help="Specify the minimum length of the reads to be considered when parsing the input file with "
              "'read_fastx.py' script, default value is 70")
@@ -396,6 +423,37 @@ def set_mapping_arguments(index, bowtie2_db):
 
     return (mpa_pkl, bowtie2db)
 
+def write_mpa_pkl_cache(mpa, mpa_pkl, cache):
+    tmp_cache = None
+    try:
+        with tf.NamedTemporaryFile(dir=os.path.dirname(cache) or '.', prefix='.mpa_cache_', delete=False) as outf:
+            tmp_cache = outf.name
+            pickle.dump(mpa, outf, protocol=pickle.HIGHEST_PROTOCOL)
+        shutil.copymode(mpa_pkl, tmp_cache)
+        os.replace(tmp_cache, cache)
+    except OSError as e:
+        sys.stderr.write('Warning: Unable to write the uncompressed database cache {}: {}\n'.format(cache, e))
+        if tmp_cache and os.path.exists(tmp_cache):
+            os.unlink(tmp_cache)
+
+def load_mpa_pkl(mpa_pkl, nproc=1, write_cache=False):
+    # the bz2-compressed database can be decompressed once into an uncompressed sidecar
+    cache = mpa_pkl + '.uncompressed.pkl'
+    if os.access(cache, os.R_OK) and os.path.getmtime(cache) >= os.path.getmtime(mpa_pkl):
+        mpa_pkl = cache
+    with open(mpa_pkl, 'rb') as a:
+        if a.read(3) == b'BZh':
+            a.seek(0)
+            # indexed_bzip2 decompresses the bzip2 blocks in parallel
+            with indexed_bzip2.open(a, parallelization=nproc) if indexed_bzip2 else bz2.BZ2File(a, 'r') as b:
+                mpa = pickle.load(b)
+            if write_cache:
+                write_mpa_pkl_cache(mpa, mpa_pkl, cache)
+            return mpa
+        # an uncompressed database is unpickled straight from the memory-mapped file
+        with mmap.mmap(a.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return pickle.loads(m)
+
 
 def set_vsc_parameters(index, bowtie2_db):
     vsc_fna = os.path.join(bowtie2_db, "{}_VSG.fna".format(index))
@@ -445,8 +503,8 @@ def vsc_bowtie2(profile_vsc_folder, nproc, file_format="fasta",
     subp.check_call( [bt2build_call, markerfile, dbpath, '-q','--threads', str(nproc)] )
 
 
-    if not all([os.path.exists(".".join([str(dbpath), p]))
-                            for p in ["1.bt2", "2.bt2", "3.bt2", "4.bt2", "rev.1.bt2", "rev.2.bt2"]]):
+    if not all(os.path.exists(".".join([str(dbpath), p]))
+                            for p in ["1.bt2", "2.bt2", "3.bt2", "4.bt2", "rev.1.bt2", "rev.2.bt2"]):
         sys.stderr.write('Error:\nThere was an error in running bowtie2-map and not all files were generated. Stopping.\n')
         sys.exit(1)
 
@@ -513,6 +571,35 @@ def vsc_bowtie2(profile_vsc_folder, nproc, file_format="fasta",
     return VSC_report
 
 
+def open_bowtie2out(outfmt6_out, nproc):
+    if not outfmt6_out.endswith(".bz2"):
+        return open(outfmt6_out, "wb"), None
+    pbzip2 = shutil.which('pbzip2')
+    if not pbzip2:
+        return bz2.BZ2File(outfmt6_out, "w"), None
+    # pbzip2 compresses the bzip2 blocks in parallel in a separate process
+    with open(outfmt6_out, "wb") as outf:
+        compressor = subp.Popen([pbzip2, '-c', '-p{}'.format(nproc)], stdin=subp.PIPE, stdout=outf)
+    return compressor.stdin, compressor
+
+def close_bowtie2out(outf, compressor):
+    outf.close()
+    if compressor and compressor.wait() != 0:
+        sys.stderr.write("Error while compressing the BowTie2 output with pbzip2.\n")
+        sys.exit(1)
+
+def open_output(output, nproc):
+    if not output:
+        return sys.stdout
+    if not output.endswith(".zst"):
+        return open(output, "w", buffering=BUFFER_SIZE)
+    if zstandard is None:
+        sys.stderr.write("Error: the zstandard python library is needed to write the {} output.\n".format(output))
+        sys.exit(1)
+    # zstd compresses the output in background threads
+    compressor = zstandard.ZstdCompressor(level=1, threads=nproc)
+    return io.TextIOWrapper(compressor.stream_writer(open(output, "wb")))
+
 def run_bowtie2(fna_in, outfmt6_out, bowtie2_db, preset, nproc, min_mapq_val, file_format="fasta",
                 exe=None, samout=None, min_alignment_len=None, read_min_len=0, profile_vsc_folder=False):
     # checking read_fastx.py
@@ -535,114 +622,155 @@ def run_bowtie2(fna_in, outfmt6_out, bowtie2_db, preset, nproc, min_mapq_val, fi
         sys.stderr.write('OSError: "{}"\nFatal error running BowTie2. Is BowTie2 in the system path?\n'.format(e))
         sys.exit(1)
 
-    try:    
-        if fna_in:
-            readin = subp.Popen([read_fastx, '-l', str(read_min_len), fna_in], stdout=subp.PIPE, stderr=subp.PIPE)
-
-        else:
-            readin = subp.Popen([read_fastx, '-l', str(read_min_len)], stdin=sys.stdin, stdout=subp.PIPE, stderr=subp.PIPE)
-
-        bowtie2_cmd = [exe if exe else 'bowtie2', "--seed", "1992", "--quiet", "--no-unal", "--{}".format(preset),
-                       "-S", "-", "-x", bowtie2_db]
-
-        if int(nproc) > 1:
-            bowtie2_cmd += ["-p", str(nproc)]
-
-        bowtie2_cmd += ["-U", "-"]  # if not stat.S_ISFIFO(os.stat(fna_in).st_mode) else []
-
-        if file_format == "fasta":
-            bowtie2_cmd += ["-f"]
-
-        p = subp.Popen(bowtie2_cmd, stdout=subp.PIPE, stdin=readin.stdout)
-        readin.stdout.close()
-        lmybytes, outf = (mybytes, bz2.BZ2File(outfmt6_out, "w")) if outfmt6_out.endswith(".bz2") else (str, open(outfmt6_out, "w"))
-
-        if profile_vsc_folder:
-            CREAD=[]
-            list_of_viral_markers = open(profile_vsc_folder+'/viralmk.txt','w')
+    tmp_out, compressor = None, None
+    try:
+        try:    
+            if fna_in:
+                readin = subp.Popen([read_fastx, '-l', str(read_min_len), fna_in], stdout=subp.PIPE, stderr=subp.PIPE)
 
-        try:
-            if samout:
-                if samout[-4:] == '.bz2':
-                    sam_file = bz2.BZ2File(samout, 'w')
-                else:
-                    sam_file = open(samout, 'wb')
-        except IOError as e:
-            sys.stderr.write('IOError: "{}"\nUnable to open sam output file.\n'.format(e))
-            sys.exit(1)
-        for line in p.stdout:
-            if samout:
-                sam_file.write(line)
-
-            o = read_and_split_line(line)
-            if not o[0].startswith('@'):
-                if not o[2].endswith('*'):
-                    if (hex(int(o[1]) & 0x100) == '0x0'): #no secondary
-                        if mapq_filter(o[2], int(o[4]), min_mapq_val) :  # filter low mapq reads
+            else:
+                readin = subp.Popen([read_fastx, '-l', str(read_min_len)], stdin=sys.stdin, stdout=subp.PIPE, stderr=subp.PIPE)
+
+            bowtie2_cmd = [exe if exe else 'bowtie2', "--seed", "1992", "--quiet", "--no-unal", "--{}".format(preset),
+                           "-S", "-", "-x", bowtie2_db]
+
+            if int(nproc) > 1:
+                bowtie2_cmd += ["-p", str(nproc)]
+
+            bowtie2_cmd += ["-U", "-"]  # if not stat.S_ISFIFO(os.stat(fna_in).st_mode) else []
+
+            if file_format == "fasta":
+                bowtie2_cmd += ["-f"]
+
+            p = subp.Popen(bowtie2_cmd, stdout=subp.PIPE, stdin=readin.stdout, bufsize=BUFFER_SIZE)
+            readin.stdout.close()
+            # the map is written under a name unique to this run, and moved in place only once the mapping succeeded
+            with tf.NamedTemporaryFile(dir=os.path.dirname(outfmt6_out) or '.', prefix='.',
+                                       suffix='.' + os.path.basename(outfmt6_out), delete=False) as tmpf:
+                tmp_out = tmpf.name
+            outf, compressor = open_bowtie2out(tmp_out, nproc)
+
+            if profile_vsc_folder:
+                CREAD=[]
+                list_of_viral_markers = open(profile_vsc_folder+'/viralmk.txt','w')
+
+            try:
+                if samout:
+                    if samout[-4:] == '.bz2':
+                        sam_file = bz2.BZ2File(samout, 'w')
+                    else:
+                        sam_file = open(samout, 'wb')
+            except IOError as e:
+                sys.stderr.write('IOError: "{}"\nUnable to open sam output file.\n'.format(e))
+                sys.exit(1)
+            outbuf = bytearray()
+            for line in p.stdout:
+                if samout:
+                    sam_file.write(line)
+
+                if line.startswith(b'@'):
+                    continue
+                o = line.strip().split(b'\t', -1 if profile_vsc_folder else 6)
+                if not o[2].endswith(b'*'):
+                    if not int(o[1]) & 0x100: #no secondary
+                        marker = o[2].decode('utf-8')
+                        if mapq_filter(marker, int(o[4]), min_mapq_val) :  # filter low mapq reads
                             if ((min_alignment_len is None) or
-                                    (max([int(x.strip('M')) for x in re.findall(r'(\d*M)', o[5]) if x]) >= min_alignment_len)):
+                                    (max(map(int, CIGAR_MATCHES_B.findall(o[5])), default=0) >= min_alignment_len)):
                                                                 # Profile viral markers in a different way
-                                if profile_vsc_folder and o[2].startswith('VDB|'):
+                                if profile_vsc_folder and marker.startswith('VDB|'):
 
-                                    mCluster = o[2]
-                                    mGroup = o[2].split('|')[2].split('-')[0]
+                                    mCluster = marker
+                                    mGroup = marker.split('|')[2].split('-')[0]
 
                                     list_of_viral_markers.write(mGroup+'\t'+mCluster+'\n')
 
-                                    if (hex(int(o[1]) & 0x10) == '0x0'): #front read
-                                        rr=SeqRecord(Seq(o[9]),letter_annotations={'phred_quality':[ord(_)-33 for _ in o[10][::-1]]}, id=o[0])
+                                    sequence, quality = o[9].decode('utf-8'), o[10].decode('utf-8')
+                                    if not int(o[1]) & 0x10: #front read
+                                        rr=SeqRecord(Seq(sequence),letter_annotations={'phred_quality':[ord(_)-33 for _ in quality[::-1]]}, id=o[0].decode('utf-8'))
                                     else:
-                                        rr=SeqRecord(Seq(o[9]).reverse_complement(),letter_annotations={'phred_quality':[ord(_)-33 for _ in o[10][::-1]]}, id=o[0])
+                                        rr=SeqRecord(Seq(sequence).reverse_complement(),letter_annotations={'phred_quality':[ord(_)-33 for _ in quality[::-1]]}, id=o[0].decode('utf-8'))
 
                                     CREAD.append(rr)
 
                                 # normal route for non-viral markers
-                                outf.write(lmybytes("\t".join([ o[0], o[2].split('/')[0] ]) + "\n"))
-
-        if profile_vsc_folder and os.path.isdir(profile_vsc_folder):
-            SeqIO.write(CREAD,profile_vsc_folder+'/v_reads.fq','fastq')
-            list_of_viral_markers.close()
-
-        if samout:  
-            sam_file.close()
-
-        p.communicate()
-        read_fastx_stderr = readin.stderr.readlines()
-        nreads = None
-        avg_read_length = None
-        try:
-            nreads, avg_read_length = list(map(float, read_fastx_stderr[0].decode().split()))
-            if not nreads:
-                sys.stderr.write('Fatal error running MetaPhlAn. Total metagenome size was not estimated.\nPlease check your input files.\n')
-                sys.exit(1)
-            if not avg_read_length:
-                sys.stderr.write('Fatal error running MetaPhlAn. The average read length was not estimated.\nPlease check your input files.\n')
+                                outbuf += o[0]
+                                outbuf += b'\t'
+                                outbuf += o[2].split(b'/')[0]
+                                outbuf += b'\n'
+                                if len(outbuf) >= BUFFER_SIZE:
+                                    outf.write(outbuf)
+                                    outbuf.clear()
+            outf.write(outbuf)
+
+            if profile_vsc_folder and os.path.isdir(profile_vsc_folder):
+                SeqIO.write(CREAD,profile_vsc_folder+'/v_reads.fq','fastq')
+                list_of_viral_markers.close()
+
+            if samout:  
+                sam_file.close()
+
+            p.communicate()
+            read_fastx_stderr = readin.stderr.readlines()
+            nreads = None
+            avg_read_length = None
+            try:
+                nreads, avg_read_length = list(map(float, read_fastx_stderr[0].decode().split()))
+                if not nreads:
+                    sys.stderr.write('Fatal error running MetaPhlAn. Total metagenome size was not estimated.\nPlease check your input files.\n')
+                    sys.exit(1)
+                if not avg_read_length:
+                    sys.stderr.write('Fatal error running MetaPhlAn. The average read length was not estimated.\nPlease check your input files.\n')
+                    sys.exit(1)
+                outf.write(mybytes('#nreads\t{}\n'.format(int(nreads))))
+                outf.write(mybytes('#avg_read_length\t{}'.format(avg_read_length)))
+                close_bowtie2out(outf, compressor)
+            except ValueError:
+                sys.stderr.write(b''.join(read_fastx_stderr).decode())
+                close_bowtie2out(outf, compressor)
                 sys.exit(1)
-            outf.write(lmybytes('#nreads\t{}\n'.format(int(nreads))))
-            outf.write(lmybytes('#avg_read_length\t{}'.format(avg_read_length)))
-            outf.close()
-        except ValueError:
-            sys.stderr.write(b''.join(read_fastx_stderr).decode())
-            outf.close()
-            os.unlink(outfmt6_out)
-            sys.exit(1)
 
-    except OSError as e:
-        sys.stderr.write('OSError: "{}"\nFatal error running BowTie2.\n'.format(e))
-        sys.exit(1)
-    except IOError as e:
-        sys.stderr.write('IOError: "{}"\nFatal error running BowTie2.\n'.format(e))
-        sys.exit(1)
+        except OSError as e:
+            sys.stderr.write('OSError: "{}"\nFatal error running BowTie2.\n'.format(e))
+            sys.exit(1)
+        except IOError as e:
+            sys.stderr.write('IOError: "{}"\nFatal error running BowTie2.\n'.format(e))
+            sys.exit(1)
 
-    if p.returncode == 13:
-        sys.stderr.write("Permission Denied Error: fatal error running BowTie2."
-                         "Is the BowTie2 file in the path with execution and read permissions?\n")
-        sys.exit(1)
-    elif p.returncode != 0:
-        sys.stderr.write("Error while running bowtie2.\n")
-        sys.exit(1)
+        if p.returncode == 13:
+            sys.stderr.write("Permission Denied Error: fatal error running BowTie2."
+                             "Is the BowTie2 file in the path with execution and read permissions?\n")
+            sys.exit(1)
+        elif p.returncode != 0:
+            sys.stderr.write("Error while running bowtie2.\n")
+            sys.exit(1)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_out, 0o666 & ~umask)
+        os.replace(tmp_out, outfmt6_out)
+        tmp_out = None
+    finally:
+        if compressor is not None and compressor.poll() is None:
+            compressor.kill()
+        if tmp_out is not None and os.path.exists(tmp_out):
+            os.unlink(tmp_out)
+
+@njit(nogil=True)
+def disambiguate_markers(marker_ids, ext_indptr, ext_data, clade_nonzero, clade_nmarkers, perc_nonzero):
+    keep = np.ones(len(marker_ids), dtype=np.bool_)
+    for i in range(len(marker_ids)):
+        m = marker_ids[i]
+        for j in range(ext_indptr[m], ext_indptr[m+1]):
+            c = ext_data[j]
+            if clade_nmarkers[c] and clade_nonzero[c] / clade_nmarkers[c] > perc_nonzero:
+                keep[i] = False
+                break
+    return keep
 
 class TaxClade:
+    __slots__ = ( 'children', 'markers2nreads', 'name', 'father', 'uncl', 'subcl_uncl', 'abundance',
+                  'uncl_abundance', 'nreads', 'uncl_nreads', 'tax_id', 'glen', 'id', '_full_name', '_is_virus',
+                  '_n_terminals', '_descend', '_uncl_name', '_subcl_uncl_name', '_markers', '_marker_ids', '_nreads_arr', '_lens_arr' )
     min_cu_len = -1
     markers2lens = None
     stat = None
@@ -658,11 +786,18 @@ class TaxClade:
         self.abundance, self.uncl_abundance = None, 0
         self.nreads, self.uncl_nreads = 0, 0
         self.tax_id = tax_id
+        self.id = None
+        self._full_name, self._is_virus = "", False
+        self._n_terminals, self._descend = 1, self
+        self._uncl_name, self._subcl_uncl_name = None, None
+        self._markers, self._marker_ids, self._nreads_arr, self._lens_arr = None, None, None, None
 
     def add_child( self, name, tax_id ):
         new_clade = TaxClade( name, tax_id )
         self.children[name] = new_clade
         new_clade.father = self
+        new_clade._full_name = self._full_name + "|" + name if self._full_name else name
+        new_clade._is_virus = "k__Viruses" in new_clade._full_name
         return new_clade
 
 
@@ -685,17 +820,44 @@ class TaxClade:
         return "|".join(fullname[1:])
 
     def get_full_name( self ):
-        fullname = [self.name]
-        cl = self.father
-        while cl:
-            fullname = [cl.name] + fullname
-            cl = cl.father
-        return "|".join(fullname[1:])
+        return self._full_name
 
     def get_normalized_counts( self ):
         return [(m,float(n)*1000.0/(np.absolute(self.markers2lens[m] - self.avg_read_length) +1) )
                     for m,n in self.markers2nreads.items()]
 
+    # set_marker_nreads and set_markers_nreads are the only writers of markers2nreads, they keep the
+    # per-clade counters of the disambiguation (clade_nmarkers and clade_nonzero) in sync with it
+    def set_marker_nreads( self, marker, n ):
+        n_old = self.markers2nreads.get(marker)
+        if n_old is None:
+            self.clade_nmarkers[self.id] += 1
+        self.clade_nonzero[self.id] += int(n > 0) - int(bool(n_old))
+        self.markers2nreads[marker] = n
+        self._nreads_arr = None
+
+    @classmethod
+    def set_markers_nreads( cls, clades, markers, nreads ):
+        # same as set_marker_nreads for each (clade, marker, n), the counters are then updated at once
+        old_nreads = []
+        for cl, marker, n in zip(clades, markers, nreads):
+            old_nreads.append(cl.markers2nreads.get(marker, -1)) # -1 marks the markers not yet counted
+            cl.markers2nreads[marker] = n
+            cl._nreads_arr = None
+        clade_ids = np.array([cl.id for cl in clades], dtype=np.int64)
+        old_nreads, nreads = np.array(old_nreads, dtype=np.int64), np.array(nreads, dtype=np.int64)
+        cls.clade_nmarkers += np.bincount(clade_ids[old_nreads < 0], minlength=len(cls.clade_nmarkers))
+        cls.clade_nonzero += np.bincount(clade_ids, weights=(nreads > 0).astype(np.int64) - (old_nreads > 0),
+                                         minlength=len(cls.clade_nonzero)).astype(np.int64)
+
+    def get_marker_arrays( self ):
+        if self._nreads_arr is None:
+            self._markers = sorted(self.markers2nreads)
+            self._marker_ids = np.array([self.markers2ids[m] for m in self._markers], dtype=np.int64)
+            self._nreads_arr = np.array([self.markers2nreads[m] for m in self._markers], dtype=np.int64)
+            self._lens_arr = np.array([self.markers2lens[m] for m in self._markers], dtype=np.float64)
+        return self._markers, self._marker_ids, self._nreads_arr, self._lens_arr
+
     def compute_mapped_reads( self ):    
         tax_level = 't__' if SGB_ANALYSIS else 's__'
         if self.nreads != 0 or self.name.startswith(tax_level):
@@ -709,86 +871,67 @@ class TaxClade:
 
         sum_ab = sum([c.compute_abundance() for c in self.children.values()])
 
-        # rat_nreads = sorted([(self.markers2lens[marker], n_reads)
-        #                             for marker,n_reads in self.markers2nreads.items()],
-        #                                     key = lambda x: x[1])
-
-        rat_nreads, removed = [], []
-        for marker, n_reads in sorted(self.markers2nreads.items(),key=lambda x:x[0]):
-            misidentified = False
-
-            if not self.avoid_disqm:
-                for ext in self.markers2exts[marker]:
-                    ext_clade = self.taxa2clades[ext]
-                    m2nr = ext_clade.markers2nreads
-                    
-                    tocladetmp = ext_clade
-                    while len(tocladetmp.children) == 1:
-                        tocladetmp = list(tocladetmp.children.values())[0]
-                        m2nr = tocladetmp.markers2nreads
-
-                    nonzeros = sum([v>0 for v in m2nr.values()])
-                    if len(m2nr):
-                        if float(nonzeros) / len(m2nr) > self.perc_nonzero:
-                            misidentified = True
-                            removed.append( (self.markers2lens[marker],n_reads) )
-                            break
-            if not misidentified:
-                rat_nreads.append( (self.markers2lens[marker],n_reads) )
-
-        if not self.avoid_disqm and len(removed):
-            n_rat_nreads = float(len(rat_nreads))
-            n_removed = float(len(removed))
-            n_tot = n_rat_nreads + n_removed
+        markers, marker_ids, nreads_arr, lens_arr = self.get_marker_arrays()
+        if self.avoid_disqm:
+            keep = np.ones(len(markers), dtype=bool)
+        else:
+            keep = disambiguate_markers(marker_ids, self.ext_indptr, self.ext_data,
+                                        self.clade_nonzero, self.clade_nmarkers, self.perc_nonzero)
+
+        selected = np.flatnonzero(keep)
+        if not self.avoid_disqm and not keep.all():
+            removed = np.flatnonzero(~keep)
+            n_rat_nreads = len(selected)
+            n_tot = len(markers)
             n_ripr = 10
 
-            if len(self.get_terminals()) < 2:
+            if self._n_terminals < 2:
                 n_ripr = 0
 
-            if "k__Viruses" in self.get_full_name():
+            if self._is_virus:
                 n_ripr = 0
 
             if n_rat_nreads < n_ripr and n_tot > n_rat_nreads:
-                rat_nreads += removed[:n_ripr-int(n_rat_nreads)]
+                selected = np.concatenate((selected, removed[:n_ripr-n_rat_nreads]))
 
-
-        rat_nreads = sorted(rat_nreads, key = lambda x: x[1])
-
-        rat_v,nreads_v = zip(*rat_nreads) if rat_nreads else ([],[])
-        rat, nrawreads, loc_ab = float(sum(rat_v)) or -1.0, sum(nreads_v), 0.0
-        quant = int(self.quantile*len(rat_nreads))
+        quant = int(self.quantile*len(selected))
         ql,qr,qn = (quant,-quant,quant) if quant else (None,None,0)
-
-        if not SGB_ANALYSIS and self.name[0] == 't' and (len(self.father.children) > 1 or "_sp" in self.father.name or "k__Viruses" in self.get_full_name()):
-            non_zeros = float(len([n for r,n in rat_nreads if n > 0]))
-            nreads = float(len(rat_nreads))
+        # markers sorted by number of reads, ties kept in marker name order. The sorted statistics
+        # and avg_g do not depend on the order, the others keep it for the ties and the summation order
+        if self.stat in ['wavg_g','tavg_g','avg_l'] or (not qn and self.stat in ['wavg_l','tavg_l']):
+            selected = selected[np.argsort(nreads_arr[selected], kind='stable')]
+        nreads_v, rat_v = nreads_arr[selected], lens_arr[selected]
+        rat, nrawreads, loc_ab = float(rat_v.sum()) or -1.0, int(nreads_v.sum()), 0.0
+
+        if not SGB_ANALYSIS and self.name[0] == 't' and (len(self.father.children) > 1 or "_sp" in self.father.name or self._is_virus):
+            non_zeros = float(np.count_nonzero(nreads_v))
+            nreads = float(len(selected))
             if nreads == 0.0 or non_zeros / nreads < 0.7:
                 self.abundance = 0.0
                 return 0.0
 
+        den_v = np.absolute(rat_v - self.avg_read_length) + 1
+        norm_v = nreads_v / den_v
+
         if rat < 0.0:
             pass
         elif self.stat == 'avg_g' or (not qn and self.stat in ['wavg_g','tavg_g']):
             loc_ab = nrawreads / rat if rat >= 0 else 0.0
         elif self.stat == 'avg_l' or (not qn and self.stat in ['wavg_l','tavg_l']):
-            loc_ab = np.mean([float(n)/(np.absolute(r - self.avg_read_length) + 1) for r,n in rat_nreads])
+            loc_ab = np.mean(norm_v)
         elif self.stat == 'tavg_g':
-            wnreads = sorted([(float(n)/(np.absolute(r-self.avg_read_length)+1),(np.absolute(r - self.avg_read_length)+1) ,n) for r,n in rat_nreads], key=lambda x:x[0])
-            den,num = zip(*[v[1:] for v in wnreads[ql:qr]])
-            loc_ab = float(sum(num))/float(sum(den)) if any(den) else 0.0
+            wnreads = np.argsort(norm_v, kind='stable')[ql:qr]
+            den, num = den_v[wnreads], nreads_v[wnreads]
+            loc_ab = float(num.sum())/float(den.sum()) if den.any() else 0.0
         elif self.stat == 'tavg_l':
-            loc_ab = np.mean(sorted([float(n)/(np.absolute(r - self.avg_read_length) + 1) for r,n in rat_nreads])[ql:qr])
+            loc_ab = np.mean(np.sort(norm_v)[ql:qr])
         elif self.stat == 'wavg_g':
-            vmin, vmax = nreads_v[ql], nreads_v[qr]
-            wnreads = [vmin]*qn+list(nreads_v[ql:qr])+[vmax]*qn
-            loc_ab = float(sum(wnreads)) / rat
+            loc_ab = float(np.clip(nreads_v, nreads_v[ql], nreads_v[qr]).sum()) / rat
         elif self.stat == 'wavg_l':
-            wnreads = sorted([float(n)/(np.absolute(r - self.avg_read_length) + 1) for r,n in rat_nreads])
-            vmin, vmax = wnreads[ql], wnreads[qr]
-            wnreads = [vmin]*qn+list(wnreads[ql:qr])+[vmax]*qn
-            loc_ab = np.mean(wnreads)
+            wnreads = np.sort(norm_v)
+            loc_ab = np.mean(np.clip(wnreads, wnreads[ql], wnreads[qr]))
         elif self.stat == 'med':
-            loc_ab = np.median(sorted([float(n)/(np.absolute(r - self.avg_read_length) +1) for r,n in rat_nreads])[ql:qr])
+            loc_ab = np.median(np.sort(norm_v)[ql:qr])
 
         self.abundance = loc_ab
         if rat < self.min_cu_len and self.children:
@@ -803,14 +946,12 @@ class TaxClade:
         return self.abundance
 
     def get_all_abundances( self ):
-        ret = [(self.name, self.tax_id, self.abundance)]
+        ret = [(self.name, self.tax_id, self.abundance, self, self._full_name)]
         if self.uncl_abundance > 0.0:
-            lchild = list(self.children.values())[0].name[:3]
-            ret += [(lchild+self.name[3:]+"_unclassified", "", self.uncl_abundance)]
+            ret += [(self._uncl_name, "", self.uncl_abundance, self, self._full_name+"|"+self._uncl_name)]
         if self.subcl_uncl and self.name[0] != tax_units[-2]:
-            cind = tax_units.index( self.name[0] )
-            ret += [(   tax_units[cind+1]+self.name[1:]+"_unclassified","",
-                        self.abundance)]
+            ret += [(   self._subcl_uncl_name,"",
+                        self.abundance, self, self._full_name+"|"+self._subcl_uncl_name)]
         for c in self.children.values():
             ret += c.get_all_abundances()
         return ret
@@ -819,29 +960,25 @@ class TaxTree:
     def __init__( self, mpa, markers_to_ignore = None ): #, min_cu_len ):
         self.root = TaxClade( "root", 0)
         self.all_clades, self.markers2lens, self.markers2clades, self.taxa2clades, self.markers2exts = {}, {}, {}, {}, {}
+        self.markers2ids = {}
         TaxClade.markers2lens = self.markers2lens
+        TaxClade.markers2ids = self.markers2ids
         TaxClade.markers2exts = self.markers2exts
         TaxClade.taxa2clades = self.taxa2clades
         self.avg_read_length = 1
+        # clade_profiles results, reset whenever the marker counts or the read length change
+        self._profiles = {}
 
+        full_names2taxids = taxonomy_taxids(mpa)
         for clade, value in mpa['taxonomy'].items():
             clade = clade.strip().split("|")
-            if isinstance(value,tuple):
-                taxids, lenc = value
-                taxids = taxids.strip().split("|")
-            if isinstance(value,int):
-                lenc = value
-                taxids = None
+            lenc = value[1] if isinstance(value,tuple) else value
 
             father = self.root
             for i in range(len(clade)):
                 clade_lev = clade[i]
-                if SGB_ANALYSIS:
-                    clade_taxid = taxids[i] if i < 8 and taxids is not None else None
-                else:
-                    clade_taxid = taxids[i] if i < 7 and taxids is not None else None
                 if not clade_lev in father.children:
-                    father.add_child(clade_lev, tax_id=clade_taxid)
+                    father.add_child(clade_lev, tax_id=full_names2taxids["|".join(clade[:i+1])])
                     self.all_clades[clade_lev] = father.children[clade_lev]
                 if SGB_ANALYSIS: father = father.children[clade_lev]
                 if clade_lev[0] == "t":
@@ -861,14 +998,57 @@ class TaxTree:
         
         add_lens(self.root)
 
-        # for k,p in mpa_pkl['markers'].items():
+        self.id2clades, to_visit = [], [self.root]
+        while to_visit:
+            node = to_visit.pop()
+            node.id = len(self.id2clades)
+            self.id2clades.append(node)
+            to_visit.extend(node.children.values())
+        # children always follow their father in id2clades
+        for node in reversed(self.id2clades):
+            if node.children:
+                node._n_terminals = sum(c._n_terminals for c in node.children.values())
+                node._uncl_name = next(iter(node.children.values())).name[:3]+node.name[3:]+"_unclassified"
+            elif node.name[0] in tax_units[:-2]:
+                node._subcl_uncl_name = tax_units[tax_units.index(node.name[0])+1]+node.name[1:]+"_unclassified"
+            if len(node.children) == 1:
+                node._descend = next(iter(node.children.values()))._descend
+        self.clade_nonzero = np.zeros(len(self.id2clades), dtype=np.int64)
+        self.clade_nmarkers = np.zeros(len(self.id2clades), dtype=np.int64)
+        TaxClade.clade_nonzero = self.clade_nonzero
+        TaxClade.clade_nmarkers = self.clade_nmarkers
+
+        # markers2exts flattened in CSR format, pointing to the clade ids used for the disambiguation
+        ext_indptr, ext_data, marker_clade_ids, unknown_exts = [0], [], [], set()
         for k, p in mpa['markers'].items():
             if k in markers_to_ignore:
                 continue
+            # the mapped markers are interned as well, so the lookups compare by identity
+            k = sys.intern(k)
+            self.markers2ids[k] = len(self.markers2ids)
             self.markers2lens[k] = p['len']
             self.markers2clades[k] = p['clade']
-            self.add_reads(k, 0)
+            # same as add_reads(k, 0), without the filters and the full name and taxids lookups
+            cl = self.all_clades[p['clade']]
+            marker_clade_ids.append(cl.id)
+            if SGB_ANALYSIS or not cl.get_full_name().startswith("k__Vir"):
+                cl.set_marker_nreads(k, 0)
             self.markers2exts[k] = p['ext']
+            for ext in p['ext']:
+                if ext in self.taxa2clades:
+                    ext_data.append(self.taxa2clades[ext]._descend.id)
+                else:
+                    unknown_exts.add(ext)
+            ext_indptr.append(len(ext_data))
+        if unknown_exts:
+            sys.stderr.write("Warning: {} external clades of the markers are not in the database taxonomy "
+                             "and are ignored in the disambiguation\n".format(len(unknown_exts)))
+        self.marker_clade_ids = np.array(marker_clade_ids, dtype=np.int64)
+        self.ext_indptr = np.array(ext_indptr, dtype=np.int64)
+        self.ext_data = np.array(ext_data, dtype=np.int64)
+        TaxClade.ext_indptr = self.ext_indptr
+        TaxClade.ext_data = self.ext_data
+        self.set_marker_filters()
 
     def set_min_cu_len( self, min_cu_len ):
         TaxClade.min_cu_len = min_cu_len
@@ -879,37 +1059,78 @@ class TaxTree:
         TaxClade.quantile = quantile
         TaxClade.avoid_disqm = avoid_disqm
         TaxClade.avg_read_length = avg_read_length
+        self._profiles.clear()
 
-    def add_reads(  self, marker, n,
+    def is_allowed_clade(  self, cl,
                     add_viruses = False,
                     ignore_eukaryotes = False,
                     ignore_bacteria = False, ignore_archaea = False, 
                     ignore_ksgbs = False, ignore_usgbs = False  ):
-        clade = self.markers2clades[marker]
-        cl = self.all_clades[clade]
         if ignore_bacteria or ignore_archaea or ignore_eukaryotes:
             cn = cl.get_full_name()
             if ignore_archaea and cn.startswith("k__Archaea"):
-                return (None, None)
+                return False
             if ignore_bacteria and cn.startswith("k__Bacteria"):
-                return (None, None)
+                return False
             if ignore_eukaryotes and cn.startswith("k__Eukaryota"):
-                return (None, None)
+                return False
         if not SGB_ANALYSIS and not add_viruses:
             cn = cl.get_full_name()
             if not add_viruses and cn.startswith("k__Vir"):
-                return (None, None)
+                return False
         if SGB_ANALYSIS and (ignore_ksgbs or ignore_usgbs):
             cn = cl.get_full_name()
             if ignore_ksgbs and not '_SGB' in cn.split('|')[-2]:
-                return (None, None)
+                return False
             if ignore_usgbs and '_SGB' in cn.split('|')[-2]:
-                return (None, None)
+                return False
+        return True
+
+    @staticmethod
+    def has_active_filters( add_viruses = False,
+                    ignore_eukaryotes = False,
+                    ignore_bacteria = False, ignore_archaea = False,
+                    ignore_ksgbs = False, ignore_usgbs = False  ):
+        # whether is_allowed_clade can reject any clade with these filters
+        return bool(ignore_bacteria or ignore_archaea or ignore_eukaryotes or
+                    (not SGB_ANALYSIS and not add_viruses) or
+                    (SGB_ANALYSIS and (ignore_ksgbs or ignore_usgbs)))
+
+    def set_marker_filters( self, **filters ):
+        if not self.has_active_filters(**filters):
+            self.allowed_markers = np.ones(len(self.marker_clade_ids), dtype=bool)
+            return
+        # the filters are fixed for a run, so they are evaluated once per clade holding markers
+        clade_ids = np.unique(self.marker_clade_ids)
+        allowed_clades = np.zeros(len(self.id2clades), dtype=bool)
+        allowed_clades[clade_ids] = [self.is_allowed_clade(self.id2clades[c], **filters) for c in clade_ids]
+        self.allowed_markers = allowed_clades[self.marker_clade_ids]
+
+    def get_marker_clade( self, marker, **filters ):
+        cl = self.all_clades[self.markers2clades[marker]]
         # while len(cl.children) == 1:
             # cl = list(cl.children.values())[0]
-        cl.markers2nreads[marker] = n
+        return cl if self.is_allowed_clade(cl, **filters) else None
+
+    def add_reads(  self, marker, n, **filters ):
+        cl = self.get_marker_clade(marker, **filters)
+        if cl is None:
+            return (None, None)
+        cl.set_marker_nreads(marker, n)
+        self._profiles.clear()
         return (cl.get_full_name(), cl.get_full_taxids(), )
 
+    def add_reads_bulk( self, markers2nreads ):
+        clades, markers, nreads = [], [], []
+        for marker, n in markers2nreads.items():
+            marker_id = self.markers2ids.get(marker)
+            if marker_id is None or not self.allowed_markers[marker_id]:
+                continue
+            clades.append(self.id2clades[self.marker_clade_ids[marker_id]])
+            markers.append(marker)
+            nreads.append(n)
+        TaxClade.set_markers_nreads(clades, markers, nreads)
+        self._profiles.clear()
 
     def markers2counts( self ):
         m2c = {}
@@ -919,6 +1140,8 @@ class TaxTree:
         return m2c
 
     def clade_profiles( self, tax_lev, get_all = False  ):
+        if (tax_lev, get_all) in self._profiles:
+            return self._profiles[(tax_lev, get_all)]
         cl2pr = {}
         for k,v in self.all_clades.items():
             if tax_lev and not k.startswith(tax_lev):
@@ -927,6 +1150,7 @@ class TaxTree:
             if not get_all and ( len(prof) < 1 or not sum([p[1] for p in prof]) > 0.0 ):
                 continue
             cl2pr[v.get_full_name()] = prof
+        self._profiles[(tax_lev, get_all)] = cl2pr
         return cl2pr
 
     def relative_abundances( self, tax_lev  ):
@@ -939,31 +1163,16 @@ class TaxTree:
             tot_ab += clade.compute_abundance()
 
         for tax_label, clade in clade2abundance_n.items():
-            for clade_label, tax_id, abundance in sorted(clade.get_all_abundances(), key=lambda pars:pars[0]):
+            for clade_label, tax_id, abundance, cl, full_name in sorted(clade.get_all_abundances(), key=lambda pars:pars[0]):
                 if SGB_ANALYSIS or clade_label[:3] != 't__':
                     if not tax_lev:
-                        if clade_label not in self.all_clades:
-                            to = tax_units.index(clade_label[0])
-                            t = tax_units[to-1]
-                            clade_label = t + clade_label.split("_unclassified")[0][1:]
-                            tax_id = self.all_clades[clade_label].get_full_taxids()
-                            clade_label = self.all_clades[clade_label].get_full_name()
-                            spl = clade_label.split("|")
-                            clade_label = "|".join(spl+[tax_units[to]+spl[-1][1:]+"_unclassified"])
-                            glen = self.all_clades[spl[-1]].glen
-                        else:
-                            glen = self.all_clades[clade_label].glen
-                            tax_id = self.all_clades[clade_label].get_full_taxids()
-                            tax_level = 't__' if SGB_ANALYSIS else 's__' 
-                            if tax_level in clade_label and abundance > 0:
-                                self.all_clades[clade_label].nreads = int(np.floor(abundance*glen))
-
-                            clade_label = self.all_clades[clade_label].get_full_name()
+                        # unclassified entries carry the clade they belong to
+                        tax_id = cl.get_full_taxids()
+                        tax_level = 't__' if SGB_ANALYSIS else 's__'
+                        if cl.name == clade_label and tax_level in clade_label and abundance > 0:
+                            cl.nreads = int(np.floor(abundance*cl.glen))
+                        clade_label = full_name
                     elif not clade_label.startswith(tax_lev):
-                        if clade_label in self.all_clades:
-                            glen = self.all_clades[clade_label].glen
-                        else:
-                            glen = 1.0
                         continue
                     clade2abundance[(clade_label, tax_id)] = abundance
         
@@ -985,6 +1194,29 @@ class TaxTree:
             ret_d[("UNCLASSIFIED", '-1')] = 1.0 - sum(ret_d.values())
         return ret_d, ret_r, tot_reads
 
+def taxonomy_taxids( mpa ):
+    # the taxid of each clade of the taxonomy by full name, in order of first appearance;
+    # shared ancestors keep the taxid of the first lineage reaching them
+    full_names2taxids = {}
+    for clade, value in mpa['taxonomy'].items():
+        clade = clade.strip().split("|")
+        taxids = value[0].strip().split("|") if isinstance(value,tuple) else None
+        for i in range(len(clade)):
+            full_name = "|".join(clade[:i+1])
+            if full_name not in full_names2taxids:
+                full_names2taxids[full_name] = taxids[i] if taxids is not None and i < (8 if SGB_ANALYSIS else 7) else None
+    return full_names2taxids
+
+def marker_lineages( mpa, markers_to_ignore = None ):
+    # the get_full_name() and get_full_taxids() of the TaxTree marker clades, without building the tree
+    clades2lineages, full_names2ids = {}, {}
+    for full_name, tax_id in taxonomy_taxids(mpa).items():
+        father, _, clade_lev = full_name.rpartition("|")
+        full_names2ids[full_name] = full_names2ids[father] + [tax_id] if father else [tax_id]
+        clades2lineages[clade_lev] = (full_name, "|".join(full_names2ids[full_name][:-1] + [tax_id or '']))
+    return {k: clades2lineages[p['clade']] for k, p in mpa['markers'].items()
+                if not markers_to_ignore or k not in markers_to_ignore}
+
 def mapq_filter(marker_name, mapq_value, min_mapq_val):
     ##if 'GeneID:' in marker_name:
     if 'GeneID:' in marker_name or 'VDB' in marker_name:
@@ -1001,40 +1233,36 @@ def separate_reads2markers(reads2markers):
     else:
         return {r: m for r, m in reads2markers.items() if ('SGB' in m or 'EUK' in m) and not 'VDB' in m}, {r: m for r, m in reads2markers.items() if 'VDB' in m and not ('SGB' in m or 'EUK' in m)}
 
-def map2bbh(mapping_f, min_mapq_val, input_type='bowtie2out', min_alignment_len=None, nreads=None, mapping_subsampling=False, subsampling=None, subsampling_seed='1992', remove_input=False):
+def map2bbh(mapping_f, min_mapq_val, input_type='bowtie2out', min_alignment_len=None, nreads=None, mapping_subsampling=False, subsampling=None, subsampling_seed='1992', remove_input=False, keep_reads=True):
     if not mapping_f:
-        ras, ras_line, inpf = plain_read_and_split, plain_read_and_split_line, sys.stdin
+        inpf = sys.stdin
     else:
-        if mapping_f.endswith(".bz2"):
-            ras, ras_line, inpf = read_and_split, read_and_split_line, bz2.BZ2File(mapping_f, "r")
-        else:
-            ras, ras_line, inpf = plain_read_and_split, plain_read_and_split_line, open(mapping_f)
+        inpf = bz2.open(mapping_f, "rt") if mapping_f.endswith(".bz2") else open(mapping_f)
 
     reads2markers = {}
     n_metagenome_reads = None
     avg_read_length = 1 #Set to 1 if it is not calculated from read_fastx
 
     if input_type == 'bowtie2out':
-        for r, c in ras(inpf):
-            if r.startswith('#') and 'nreads' in r:
-                n_metagenome_reads = int(c)
-            if r.startswith('#') and 'avg_read_length' in r:
-                avg_read_length = float(c)
-            else:
-                reads2markers[r] = c
+        reads2markers = dict(plain_read_and_split(inpf))
+        if '#nreads' in reads2markers:
+            n_metagenome_reads = int(reads2markers.pop('#nreads'))
+        if '#avg_read_length' in reads2markers:
+            avg_read_length = float(reads2markers.pop('#avg_read_length'))
     elif input_type == 'sam':
         n_metagenome_reads = nreads 
         for line in inpf:
-            o = ras_line(line)
+            # the sequence and quality fields are never split
+            o = line.split('\t', 6)
             if ((o[0][0] != '@') and #no header
                 (o[2][-1] != '*') and # no unmapped reads
-                (hex(int(o[1]) & 0x100) == '0x0') and #no secondary
+                (not int(o[1]) & 0x100) and #no secondary
                 mapq_filter(o[2], int(o[4]), min_mapq_val) and # filter low mapq reads
-                ( (min_alignment_len is None) or ( max(int(x.strip('M')) for x in re.findall(r'(\d*M)', o[5]) if x) >= min_alignment_len ) )
+                ( (min_alignment_len is None) or ( max(map(int, CIGAR_MATCHES.findall(o[5])), default=0) >= min_alignment_len ) )
             ):
                     reads2markers[o[0]] = o[2].split('/')[0]
     inpf.close()
-    
+
     if subsampling is not None and mapping_subsampling:
         if subsampling >= n_metagenome_reads:
             sys.stderr.write("WARNING: The specified subsampling ({}) is equal or higher than the original number of reads ({}). Subsampling will be skipped.\n".format(subsampling, n_metagenome_reads))
@@ -1055,13 +1283,24 @@ def map2bbh(mapping_f, min_mapq_val, input_type='bowtie2out', min_alignment_len=
             n_metagenome_reads = subsampling
     elif subsampling is None and n_metagenome_reads < 10000:
         sys.stderr.write("WARNING: The number of reads in the sample ({}) is below the recommended minimum of 10,000 reads.\n".format(n_metagenome_reads))
-        
-    markers2reads = defdict(set)   
-    for r, m in reads2markers.items():
-        markers2reads[m].add(r)
+
+    # the markers are factorized once, so the grouping sorts and counts integer codes
+    codes, markers = pd.factorize(np.array(list(reads2markers.values()), dtype=object))
+    counts = np.bincount(codes, minlength=len(markers))
+    if keep_reads:
+        reads = np.array(list(reads2markers), dtype=object)[np.argsort(codes, kind='stable')]
+        edges = np.r_[0, counts.cumsum()]
+        markers2reads = {sys.intern(m): set(reads[s:e]) for m, s, e in zip(markers, edges[:-1], edges[1:])}
+    else: # only the number of reads mapping each marker
+        markers2reads = dict(zip(map(sys.intern, markers), counts.tolist()))
 
     return (markers2reads, n_metagenome_reads, avg_read_length)
 
+def sort_predictions(predictions):
+    # higher ranks first, then by decreasing relative abundance; the key is computed once per clade
+    keys = [relab + 100.0*(8-taxstr.count("|")) for taxstr, _, relab in predictions]
+    return [predictions[i] for i in sorted(range(len(predictions)), key=keys.__getitem__, reverse=True)]
+
 def maybe_generate_biom_file(tree, pars, abundance_predictions):
     json_key = "MetaPhlAn"
 
@@ -1093,14 +1332,14 @@ def maybe_generate_biom_file(tree, pars, abundance_predictions):
 
     clades = iter((abundance, findclade(name))
                   for (name, taxid, abundance) in abundance_predictions if istip(name))
-    packed = iter(([abundance], clade.get_full_name(), clade.tax_id)
+    packed = iter((abundance, clade.get_full_name(), clade.tax_id)
                   for (abundance, clade) in clades)
 
     # unpack that tuple here to stay under 80 chars on a line
     data, clade_names, _ = zip(*packed)
     # biom likes column vectors, so we give it an array like this:
     # np.array([a],[b],[c])
-    data = np.array(data)
+    data = np.array(data, dtype=np.float64).reshape(-1, 1)
     sample_ids = [pars['sample_id']]
     table_id = 'MetaPhlAn_Analysis'
 
@@ -1126,19 +1365,23 @@ def maybe_generate_biom_file(tree, pars, abundance_predictions):
             table_id             = table_id,
             constructor          = biom.table.DenseOTUTable
         )
-        with open(pars['biom'], 'w') as outfile:
-            json.dump( biom_table.getBiomFormatObject(json_key),
-                           outfile )
+        if orjson is not None:
+            with open(pars['biom'], 'wb') as outfile:
+                outfile.write( orjson.dumps( biom_table.getBiomFormatObject(json_key),
+                                             option = orjson.OPT_SERIALIZE_NUMPY ) )
+        else:
+            with open(pars['biom'], 'w') as outfile:
+                json.dump( biom_table.getBiomFormatObject(json_key),
+                               outfile )
     else:  # Below is the biom2 compatible code
         biom_table = biom.table.Table(
-            data,
+            scipy.sparse.csr_matrix(data),
             #clade_ids,           #Modified by George Weingart 5/22/2017 - We will use instead the clade_names
             clade_names,          #Modified by George Weingart 5/22/2017 - We will use instead the clade_names
             sample_ids,
             sample_metadata      = None,
             observation_metadata = list(map(to_biomformat, clade_names)),
-            table_id             = table_id,
-            input_is_dense       = True
+            table_id             = table_id
         )
 
         with open(pars['biom'], 'w') as outfile:
@@ -1371,6 +1614,7 @@ def main():
                               "Exiting...\n\n" )
             sys.exit(1)
 
+        reuse_map = False
         if pars['no_map']:
             pars['bowtie2out'] = tf.NamedTemporaryFile(dir=pars['tmp_dir']).name
             no_map = True
@@ -1387,7 +1631,10 @@ def main():
                     fname = "fifo_map"
                 pars['bowtie2out'] = fname + ".bowtie2out.txt"
 
-            if os.path.exists( pars['bowtie2out'] ) and not pars['force']:
+            reuse_map = (pars['reuse_bowtie2out'] and not pars['force'] and not pars['profile_vsc'] and
+                         pars['inp'] is not None and os.path.exists( pars['bowtie2out'] ) and
+                         all(os.path.getmtime(pars['bowtie2out']) >= os.path.getmtime(inp_f) for inp_f in pars['inp'].split(',')))
+            if os.path.exists( pars['bowtie2out'] ) and not pars['force'] and not reuse_map:
                 sys.stderr.write(
                     "BowTie2 output file detected: " + pars['bowtie2out'] + "\n"
                     "Please use it as input or remove it if you want to "
@@ -1399,8 +1646,8 @@ def main():
                     os.remove( pars['bowtie2out'] )
 
         bt2_ext = 'bt2l' if SGB_ANALYSIS else 'bt2'            
-        if bow and not all([os.path.exists(".".join([str(pars['bowtie2db']), p]))
-                            for p in ["1." + bt2_ext, "2." + bt2_ext, "3." + bt2_ext, "4." + bt2_ext, "rev.1." + bt2_ext, "rev.2." + bt2_ext]]):
+        if bow and not all(os.path.exists(".".join([str(pars['bowtie2db']), p]))
+                            for p in ["1." + bt2_ext, "2." + bt2_ext, "3." + bt2_ext, "4." + bt2_ext, "rev.1." + bt2_ext, "rev.2." + bt2_ext]):
             sys.stderr.write("No MetaPhlAn BowTie2 database found (--index "
                              "option)!\nExpecting location {}\nExiting..."
                              .format(pars['bowtie2db']))
@@ -1411,7 +1658,9 @@ def main():
                              .format(pars['bowtie2db']))
             sys.exit(1)
 
-        if bow:
+        if bow and reuse_map:
+            pars['input_type'] = 'bowtie2out'
+        elif bow:
             run_bowtie2(pars['inp'], pars['bowtie2out'], pars['bowtie2db'],
                                 pars['bt2_ps'], pars['nproc'], file_format=pars['input_type'],
                                 exe=pars['bowtie2_exe'], samout=pars['samout'],
@@ -1422,12 +1671,18 @@ def main():
                     os.remove(inp_f)
             pars['input_type'] = 'bowtie2out'
         pars['inp'] = pars['bowtie2out'] # !!!
-    with bz2.BZ2File( pars['mpa_pkl'], 'r' ) as a:
-        mpa_pkl = pickle.load( a )
+    mpa_pkl = load_mpa_pkl( pars['mpa_pkl'], pars['nproc'], pars['uncompressed_db_cache'] )
 
     REPORT_MERGED = mpa_pkl.get('merged_taxon',False)
-    tree = TaxTree( mpa_pkl, ignore_markers )
-    tree.set_min_cu_len( pars['min_cu_len'] )
+    clade_filters = { f: pars[f] for f in ['add_viruses', 'ignore_eukaryotes', 'ignore_bacteria', 'ignore_archaea',
+                                           'ignore_ksgbs', 'ignore_usgbs'] }
+    # the reads map only needs the marker lineages, the tree is built when the clades have to be filtered
+    tree, markers2lineages = None, None
+    if pars['t'] == 'reads_map':
+        markers2lineages = marker_lineages( mpa_pkl, ignore_markers )
+    if pars['t'] != 'reads_map' or ESTIMATE_UNK or TaxTree.has_active_filters(**clade_filters):
+        tree = TaxTree( mpa_pkl, ignore_markers )
+        tree.set_min_cu_len( pars['min_cu_len'] )
 
     if pars['input_type'] == 'sam' and not pars['nreads']:
         sys.stderr.write(
@@ -1436,7 +1691,7 @@ def main():
                 "\nExiting...\n\n" )
         sys.exit(1)
 
-    markers2reads, n_metagenome_reads, avg_read_length = map2bbh(pars['inp'], pars['min_mapq_val'], pars['input_type'], pars['min_alignment_len'], pars['nreads'], pars['mapping_subsampling'], pars['subsampling'], pars['subsampling_seed'])
+    markers2reads, n_metagenome_reads, avg_read_length = map2bbh(pars['inp'], pars['min_mapq_val'], pars['input_type'], pars['min_alignment_len'], pars['nreads'], pars['mapping_subsampling'], pars['subsampling'], pars['subsampling_seed'], keep_reads=pars['t'] == 'reads_map')
 
     if pars['profile_vsc']:
         
@@ -1488,40 +1743,35 @@ def main():
                     vsc_out_df.to_csv(outf,sep='\t',na_rep='-')
 
 
-    tree.set_stat( pars['stat'], pars['stat_q'], pars['perc_nonzero'], avg_read_length, pars['avoid_disqm'])
-
     if no_map:
         os.remove( pars['inp'] )
 
-    map_out = []
-    for marker,reads in sorted(markers2reads.items(), key=lambda pars: pars[0]):
-        if marker not in tree.markers2lens:
-            continue
-        tax_seq, ids_seq = tree.add_reads( marker, len(reads),
-                                  add_viruses = pars['add_viruses'],
-                                  ignore_eukaryotes = pars['ignore_eukaryotes'],
-                                  ignore_bacteria = pars['ignore_bacteria'],
-                                  ignore_archaea = pars['ignore_archaea'],
-                                  ignore_ksgbs = pars['ignore_ksgbs'],
-                                  ignore_usgbs = pars['ignore_usgbs']
-                                  )
-        if tax_seq:
-            map_out +=["\t".join([r,tax_seq, ids_seq]) for r in sorted(reads)]
+    if tree is not None:
+        tree.set_stat( pars['stat'], pars['stat_q'], pars['perc_nonzero'], avg_read_length, pars['avoid_disqm'])
+        tree.set_marker_filters( **clade_filters )
+        if pars['t'] != 'reads_map':
+            tree.add_reads_bulk( markers2reads )
+        else:
+            tree.add_reads_bulk( {marker: len(reads) for marker, reads in markers2reads.items()} )
+            markers2lineages = { marker: markers2lineages[marker] for marker in markers2reads
+                                    if marker in markers2lineages and tree.allowed_markers[tree.markers2ids[marker]] }
 
     if pars['output'] is None and pars['output_file'] is not None:
         pars['output'] = pars['output_file']
 
-    out_stream = open(pars['output'],"w") if pars['output'] else sys.stdout
+    out_stream = open_output(pars['output'], pars['nproc'])
     MPA2_OUTPUT = pars['legacy_output']
     CAMI_OUTPUT = pars['CAMI_format_output']
+    GROUP_REPR = pars['use_group_representative']
 
     with out_stream as outf:
+        t, tax_lev = pars['t'], pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None
         if not MPA2_OUTPUT:
             outf.write('#{}\n'.format(pars['index']))
             outf.write('#{}\n'.format(' '.join(sys.argv)))
             outf.write('#{} reads processed\n'.format(n_metagenome_reads))
         
-        if pars['t'] == 'rel_ab_w_read_stats':
+        if t == 'rel_ab_w_read_stats':
             outf.write('#Average read length {}\n'.format(avg_read_length))           
 
         if not CAMI_OUTPUT:
@@ -1529,8 +1779,8 @@ def main():
 
         if ESTIMATE_UNK:
             mapped_reads = 0
-            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
-            cl2ab, _, _ = tree.relative_abundances( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None )
+            cl2pr = tree.clade_profiles( tax_lev )
+            cl2ab, _, _ = tree.relative_abundances( tax_lev )
             confident_taxa = [taxstr for (taxstr, _),relab in cl2ab.items() if relab > 0.0]
             for c, m in cl2pr.items():
                 if c in confident_taxa:
@@ -1541,30 +1791,48 @@ def main():
         else:
             fraction_mapped_reads = 1.0
       
-        if pars['t'] == 'reads_map':
+        if t == 'reads_map':
             if not MPA2_OUTPUT:
                outf.write('#read_id\tNCBI_taxlineage_str\tNCBI_taxlineage_ids\n')
-            outf.write( "\n".join( map_out ) + "\n" )
+            # the lineage is encoded once per marker, as the text stream would encode it, and the
+            # lines of the marker go to the binary buffer in one write
+            out_buffer = getattr(outf, 'buffer', None)
+            if out_buffer is not None:
+                outf.flush()
+                encoding, errors = outf.encoding, outf.errors
+            n_mapped = 0
+            for marker,reads in sorted(markers2reads.items(), key=lambda pars: pars[0]):
+                if marker not in markers2lineages:
+                    continue
+                tax_seq, ids_seq = markers2lineages[marker]
+                suffix = "\t".join(["", tax_seq, ids_seq]) + "\n"
+                if out_buffer is None:
+                    outf.writelines( r + suffix for r in sorted(reads) )
+                else:
+                    suffix = suffix.encode(encoding, errors)
+                    out_buffer.write( b"".join(r.encode(encoding, errors) + suffix for r in sorted(reads)) )
+                n_mapped += 1
+            if not n_mapped:
+                outf.write( "\n" )
 
-        elif pars['t'] == 'rel_ab':
+        elif t == 'rel_ab':
             if CAMI_OUTPUT:
                 outf.write('''@SampleID:{}\n@Version:0.10.0\n@Ranks:superkingdom|phylum|class|order|family|genus|species|strain\n@@TAXID\tRANK\tTAXPATH\tTAXPATHSN\tPERCENTAGE\n'''.format(pars["sample_id"]))
             if not MPA2_OUTPUT and not CAMI_OUTPUT:
-                if not pars['use_group_representative']:
+                if not GROUP_REPR:
                     outf.write('#clade_name\tNCBI_tax_id\trelative_abundance\tadditional_species\n')
                 else:
                     outf.write('#clade_name\tNCBI_tax_id\trelative_abundance\n')
 
             cl2ab, _, tot_nreads = tree.relative_abundances(
-                        pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None )
+                        tax_lev )
             
             outpred = [(taxstr, taxid,round(relab*100.0,5)) for (taxstr, taxid), relab in cl2ab.items() if relab > 0.0]
             has_repr = False
             
             if outpred:
                 if CAMI_OUTPUT:
-                    for clade, taxid, relab in sorted(  outpred, reverse=True,
-                                        key=lambda x:x[2]+(100.0*(8-(x[0].count("|"))))):
+                    for clade, taxid, relab in sort_predictions(outpred):
                         if taxid and clade.split('|')[-1][0] != 't':
                             rank = ranks2code[clade.split('|')[-1][0]]
                             leaf_taxid = taxid.split('|')[-1]
@@ -1576,14 +1844,13 @@ def main():
                                                     "-1",
                                                     str(round((1-fraction_mapped_reads)*100,5)),""]) + "\n" )
                                                     
-                    for clade, taxid, relab in sorted(  outpred, reverse=True,
-                                        key=lambda x:x[2]+(100.0*(8-(x[0].count("|"))))):
+                    for clade, taxid, relab in sort_predictions(outpred):
                         add_repr = ''
                         if REPORT_MERGED and (clade, taxid) in mpa_pkl['merged_taxon']:
-                            if pars['use_group_representative'] and not SGB_ANALYSIS:
+                            if GROUP_REPR and not SGB_ANALYSIS:
                                 if '_group' in clade:
                                     clade, taxid, _ = sorted(mpa_pkl['merged_taxon'][(clade, taxid)], key=lambda x:x[2], reverse=True)[0]
-                            elif not pars['use_group_representative']:
+                            elif not GROUP_REPR:
                                 add_repr = '{}'.format(','.join( [ n[0] for n in mpa_pkl['merged_taxon'][(clade, taxid)]] ))
                                 has_repr = True
                         if not MPA2_OUTPUT:
@@ -1607,9 +1874,9 @@ def main():
                 sys.stderr.write("WARNING: MetaPhlAn did not detect any microbial taxa in the sample.\n")
             maybe_generate_biom_file(tree, pars, outpred)
 
-        elif pars['t'] == 'rel_ab_w_read_stats':
+        elif t == 'rel_ab_w_read_stats':
             cl2ab, rr, tot_nreads = tree.relative_abundances(
-                        pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None )
+                        tax_lev )
 
             unmapped_reads = max(n_metagenome_reads - tot_nreads, 0)
 
@@ -1629,8 +1896,7 @@ def main():
                                                 "-",
                                                 str(round(unmapped_reads)) ]) + "\n" )
                                                 
-                for taxstr, taxid, relab in sorted(  outpred, reverse=True,
-                                    key=lambda x:x[2]+(100.0*(8-(x[0].count("|"))))):
+                for taxstr, taxid, relab in sort_predictions(outpred):
                     outf.write( "\t".join( [    taxstr,
                                                 taxid,
                                                 str(relab),
@@ -1650,40 +1916,43 @@ def main():
                     outf.write( "unclassified\t100.0\n" )
             maybe_generate_biom_file(tree, pars, outpred)
 
-        elif pars['t'] == 'clade_profiles':
-            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
+        elif t == 'clade_profiles':
+            cl2pr = tree.clade_profiles( tax_lev )
             for c,p in cl2pr.items():
                 mn,n = zip(*p)
                 outf.write( "\t".join( [""]+[str(s) for s in mn] ) + "\n" )
                 outf.write( "\t".join( [c]+[str(s) for s in n] ) + "\n" )
 
-        elif pars['t'] == 'marker_ab_table':
-            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
+        elif t == 'marker_ab_table':
+            cl2pr = tree.clade_profiles( tax_lev )
+            nreads = float(pars['nreads']) if pars['nreads'] else None
             for v in cl2pr.values():
-                outf.write( "\n".join(["\t".join([str(a),str(b/float(pars['nreads'])) if pars['nreads'] else str(b)])
-                                for a,b in v if b > 0.0]) + "\n" )
+                outf.write( "\n".join("\t".join([str(a),str(b/nreads) if nreads else str(b)])
+                                for a,b in v if b > 0.0) + "\n" )
 
-        elif pars['t'] == 'marker_pres_table':
-            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
+        elif t == 'marker_pres_table':
+            cl2pr = tree.clade_profiles( tax_lev )
+            pres_th = pars['pres_th']
             for v in cl2pr.values():
-                strout = ["\t".join([str(a),"1"]) for a,b in v if b > pars['pres_th']]
+                strout = "\n".join(a+"\t1" for a,b in v if b > pres_th)
                 if strout:
-                    outf.write( "\n".join(strout) + "\n" )
+                    outf.write( strout + "\n" )
 
-        elif pars['t'] == 'marker_counts':
+        elif t == 'marker_counts':
             outf.write( "\n".join( ["\t".join([m,str(c)]) for m,c in tree.markers2counts().items() ]) +"\n" )
 
-        elif pars['t'] == 'clade_specific_strain_tracker':
+        elif t == 'clade_specific_strain_tracker':
             cl2pr = tree.clade_profiles( None, get_all = True  )
             cl2ab, _, _ = tree.relative_abundances( None )
             strout = []
+            sel_clade, min_ab, pres_th = pars['clade'], pars['min_ab'], pars['pres_th']
             for (taxstr, taxid), relab in cl2ab.items():
                 clade = taxstr
-                if clade.endswith(pars['clade']) and relab*100.0 < pars['min_ab']:
+                if clade.endswith(sel_clade) and relab*100.0 < min_ab:
                     strout = []
                     break
-                if pars['clade'] in clade:
-                    strout += ["\t".join([str(a),str(int(b > pars['pres_th']))]) for a,b in cl2pr[clade]]
+                if sel_clade in clade:
+                    strout += ["\t".join([str(a),str(int(b > pres_th))]) for a,b in cl2pr[clade]]
             if strout:
                 strout = sorted(strout,key=lambda x:x[0])
                 outf.write( "\n".join(strout) + "\n" )